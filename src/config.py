@@ -0,0 +1,17 @@
+import functools
+import json
+
+
+@functools.lru_cache(maxsize=1)
+def load_configurations() -> dict:
+    """Method to load the configurations file. It is parsed only once and
+    the same configurations are returned on subsequent calls.
+
+    Args:
+        None
+
+    Returns:
+        dict: the configurations.
+    """
+    with open("configurations.json", "r") as f:
+        return json.load(f)
@@ -1,24 +1,106 @@
 import os
-import json
-import utils
+import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterator
+import text_processing
 import argparse
 import logging
 from logging_config import setup_logging
+from config import load_configurations
 
 # load the configurations file
-with open("configurations.json", "r") as f:
-    configurations = json.load(f)
+configurations = load_configurations()
 
 # path of folders to the collection of docs/books and database
 DOCUMENT_COLLECTION_FOLDER_RELPATH = os.path.join(
     os.path.dirname(__file__),
     configurations["document_collection_folder_relpath"])
 
-# set up logging
-setup_logging()
+# worker processes started with spawn or forkserver import this module
+# again, so the embedding and indexing libraries in utils are only imported
+# inside the functions run by the main process and logging is only set up
+# when run as a script
 logger = logging.getLogger("rag_data_management_logger")
 
 
+def embed_files(file_paths: list[str], conn: sqlite3.Connection,
+                cursor: sqlite3.Cursor) -> None:
+    """Method to extract, chunk and embed the documents/books as a pipeline.
+    The text extraction and chunking is done in parallel in worker processes
+    while the main process embeds and stores the documents already
+    extracted. At most one document per worker plus the number of
+    "extra_queued_documents" in the configurations are queued, so that the
+    memory usage stays bounded.
+
+    Args:
+        file_paths (list(str)): list of file paths to process.
+        conn (sqlite3.Connection): connection object.
+        cursor (sqlite3.Cursor): cursor object.
+
+    Returns:
+        None
+    """
+    # nothing to embed, so neither start the workers nor load the model
+    if not file_paths:
+        return
+    max_workers = os.cpu_count()
+    max_queued_docs = max_workers + configurations["processing_parameters"][
+        "extra_queued_documents"]
+    paths = iter(file_paths)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            embed_queued_files(paths, max_queued_docs, executor, conn, cursor)
+        except BaseException:
+            # do not wait for the queued documents before raising the error
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+def embed_queued_files(paths: Iterator[str], max_queued_docs: int,
+                       executor: ProcessPoolExecutor,
+                       conn: sqlite3.Connection,
+                       cursor: sqlite3.Cursor) -> None:
+    """Method to queue the documents/books for extraction and chunking in the
+    worker processes and to embed and store them in the order of the file
+    paths as their extraction completes.
+
+    Args:
+        paths (Iterator[str]): iterator over the file paths to process.
+        max_queued_docs (int): maximum number of documents queued at once.
+        executor (ProcessPoolExecutor): the pool of worker processes.
+        conn (sqlite3.Connection): connection object.
+        cursor (sqlite3.Cursor): cursor object.
+
+    Returns:
+        None
+    """
+    import utils
+    # the last modified time is taken before the text is extracted, so
+    # that a file changed during the extraction is embedded again later
+    queued_docs = deque(
+        (utils.get_last_modified(path),
+         executor.submit(text_processing.extract_and_chunk_text, path))
+        for path in islice(paths, max_queued_docs))
+    # the worker processes are started by the first submit, so the model
+    # is loaded afterwards to keep torch and cuda out of forked workers
+    model = utils.load_embedding_model()
+    # the futures are consumed in the order of the file paths
+    while queued_docs:
+        last_modified, queued_doc = queued_docs.popleft()
+        path, chuncked_text = queued_doc.result()
+        next_path = next(paths, None)
+        if next_path is not None:
+            queued_docs.append(
+                (utils.get_last_modified(next_path),
+                 executor.submit(text_processing.extract_and_chunk_text,
+                                 next_path)))
+        doc_id = utils.get_doc_id(path, conn, cursor)
+        utils.embed_and_store_chunks(doc_id, chuncked_text, conn, cursor,
+                                     model, last_modified)
+
+
 def build_databases_and_faiss_index():
     """Method to build a database that maintains the list of all docs
     and embeddings of its chunks. Also a faiss index file is built and
@@ -30,19 +112,16 @@ def build_databases_and_faiss_index():
     Returns:
         None
     """
+    import utils
     conn, cursor = utils.create_database()
     try:
         file_paths = utils.get_filepaths(DOCUMENT_COLLECTION_FOLDER_RELPATH,
                                          (".pdf",))
-        utils.insert_files_metainfo_into_database(conn, cursor, file_paths)
-        for path in file_paths:
-            extracted_text = utils.extract_text_from_pdf(path)
-            chuncked_text = utils.chunk_text(extracted_text)
-            doc_id = utils.get_doc_id(path, conn, cursor)
-            utils.embed_and_store_chunks(doc_id, chuncked_text, conn, cursor)
-        faiss_index, mapping_data = utils.build_faiss_index(cursor)
+        file_paths = utils.insert_files_metainfo_into_database(conn, cursor,
+                                                               file_paths)
+        embed_files(file_paths, conn, cursor)
+        faiss_index = utils.build_faiss_index(conn, cursor)
         utils.save_faiss_index(faiss_index)
-        utils.save_faiss_mapping(mapping_data, conn, cursor)
         conn.close()
         logger.info("Completed: Built all the databases and faiss index.")
     except Exception as e:
@@ -52,8 +131,9 @@ def build_databases_and_faiss_index():
 
 def update_databases_and_faiss_index():
     """Method to update the database that maintains the list of all docs
-    and embeddings of its chunks when some files are deleted or added to the
-    collection. Also the faiss index is rebuilt and saved.
+    and embeddings of its chunks when some files are deleted, modified or
+    added to the collection. Only the new and modified files are embedded.
+    Also the faiss index is rebuilt and saved.
 
     Args:
         None
@@ -61,28 +141,32 @@ def update_databases_and_faiss_index():
     Returns:
         None
     """
+    import utils
     conn, cursor = utils.connect_to_db()
     try:
-        deleted_files_paths = utils.get_list_of_deleted_files(
-            DOCUMENT_COLLECTION_FOLDER_RELPATH, conn, cursor)
+        utils.check_database_schema(cursor)
+        # before any embeddings are appended to the embeddings file
+        utils.recover_embeddings_file(cursor)
+        # databases built by older versions may not have the indexes yet
+        utils.create_indexes(conn, cursor)
+        new_files_path, modified_files_path, deleted_files_paths = \
+            utils.get_list_of_changed_files(
+                DOCUMENT_COLLECTION_FOLDER_RELPATH, conn, cursor)
         if deleted_files_paths:
             utils.delete_file_metadata_in_db(deleted_files_paths,
                                              conn, cursor)
-        new_files_path = utils.get_list_of_new_files(
-            DOCUMENT_COLLECTION_FOLDER_RELPATH, conn, cursor)
         if new_files_path:
-            utils.insert_files_metainfo_into_database(conn, cursor,
-                                                      new_files_path)
-            utils.delete_faiss_index(conn, cursor)
-            for path in new_files_path:
-                extracted_text = utils.extract_text_from_pdf(path)
-                chuncked_text = utils.chunk_text(extracted_text)
-                doc_id = utils.get_doc_id(path, conn, cursor)
-                utils.embed_and_store_chunks(doc_id, chuncked_text, conn,
-                                             cursor)
-            faiss_index, mapping_data = utils.build_faiss_index(cursor)
+            new_files_path = utils.insert_files_metainfo_into_database(
+                conn, cursor, new_files_path)
+        if new_files_path or modified_files_path or deleted_files_paths \
+                or not os.path.exists(utils.FAISS_INDEX_FPATH):
+            utils.delete_faiss_index()
+            # only the new and modified files need to be embedded, the
+            # embeddings of the modified files are replaced when they are
+            # stored
+            embed_files(new_files_path + modified_files_path, conn, cursor)
+            faiss_index = utils.build_faiss_index(conn, cursor)
             utils.save_faiss_index(faiss_index)
-            utils.save_faiss_mapping(mapping_data, conn, cursor)
         conn.close()
         logger.info("Completed: Updated all the databases and rebuilt the "
                     "faiss index.")
@@ -92,6 +176,7 @@ def update_databases_and_faiss_index():
 
 
 if __name__ == "__main__":
+    setup_logging()
     parser = argparse.ArgumentParser(description="Choose an operation.")
     parser.add_argument("choice",
                         choices=["rebuild_all", "update_only"],
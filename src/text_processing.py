@@ -0,0 +1,105 @@
+import re
+import pymupdf
+from nltk.tokenize import sent_tokenize
+from config import load_configurations
+
+# this module is imported by the worker processes that extract the text, so
+# it must not import the embedding and indexing libraries
+
+# load the configurations file
+configurations = load_configurations()
+
+# sentence boundary: end punctuation followed by whitespace and a capital
+# letter, opening quote or bracket
+SENTENCE_SPLIT_REGEX = re.compile(r"(?<=[.!?])\s+(?=[A-Z\"'(\[])")
+
+# sentence splitter used to chunk the text
+SENTENCE_SPLITTERS = ("regex", "nltk")
+SENTENCE_SPLITTER = configurations["processing_parameters"][
+    "sentence_splitter"]
+if SENTENCE_SPLITTER not in SENTENCE_SPLITTERS:
+    raise ValueError(f"Unsupported sentence splitter: '{SENTENCE_SPLITTER}'. "
+                     f"Supported values are: {', '.join(SENTENCE_SPLITTERS)}")
+
+
+def extract_text_from_pdf(pdf_path: str) -> list[tuple[int, str]]:
+    """Method to extract the text from the documents/books. Pages without
+    any text are skipped.
+
+    Args:
+        pdf_path (str): the path of the document.
+
+    Returns:
+        list[tuple[int, str]]: a list of tuples representing the page number
+        and the corresponding text for all pages in the document specified by
+        the path.
+    """
+    extracted_text = []
+    with pymupdf.open(pdf_path) as doc:
+        for page_num, page in enumerate(doc, start=1):
+            text = page.get_textpage().extractText()
+            if text.strip():
+                extracted_text.append((page_num, text))
+    return extracted_text
+
+
+def split_sentences(text: str) -> list[str]:
+    """Method to split the text into sentences using the sentence splitter
+    specified in the configurations. The "regex" splitter is much faster
+    than the "nltk" splitter but less accurate.
+
+    Args:
+        text (str): the text to split.
+
+    Returns:
+        list[str]: list of sentences.
+    """
+    if SENTENCE_SPLITTER == "nltk":
+        return sent_tokenize(text)
+    return [sentence for sentence in SENTENCE_SPLIT_REGEX.split(text.strip())
+            if sentence]
+
+
+def chunk_text(doc: list[tuple[int, str]], window_size: int = 3,
+               stride: int = 2)\
+               -> list[tuple[int, str]]:
+    """Method to split the text into chunks of a sentences of specified
+    size and stride.
+
+    Args:
+        doc (list[int, str]): a list of tuples representing the page number
+        and the corresponding text representing the whole document.
+        window_size (int): the number of sentences to combine to make
+        a chunk.
+        stride (int): the number of sentences to skip when combining
+        sentences to make a chunk.
+
+    Returns:
+        list[int, str]: a list of tuples representing the page number
+        and the corresponding text chunk.
+    """
+    chunked_text = []
+    # bind the methods locally to avoid attribute lookups in the loop
+    join = " ".join
+    extend = chunked_text.extend
+    for page_num, content in doc:
+        sentences = split_sentences(content)
+        extend((page_num, join(sentences[i: i + window_size]))
+               for i in range(0, len(sentences) + 1 - window_size, stride))
+    return chunked_text
+
+
+def extract_and_chunk_text(pdf_path: str)\
+                           -> tuple[str, list[tuple[int, str]]]:
+    """Method to extract the text from a document/book and split it into
+    chunks. It is used as a worker to process the documents in parallel.
+
+    Args:
+        pdf_path (str): the path of the document.
+
+    Returns:
+        tuple[str, list[tuple[int, str]]]: the path of the document and a list
+        of tuples representing the page number and the corresponding text
+        chunk.
+    """
+    return pdf_path, chunk_text(extract_text_from_pdf(pdf_path))
@@ -1,19 +1,16 @@
 import os
 import sqlite3
-from datetime import datetime
-import json
-import pymupdf
-from nltk.tokenize import sent_tokenize
+import time
 from sentence_transformers import SentenceTransformer
-import pickle
 import numpy as np
+import torch
 import faiss
 import logging
 from logging_config import setup_logging
+from config import load_configurations
 
 # load the configurations file
-with open("configurations.json", "r") as f:
-    configurations = json.load(f)
+configurations = load_configurations()
 
 # path of folders to the collection of docs/books and database
 DOCUMENT_COLLECTION_FOLDER_RELPATH = os.path.join(
@@ -27,18 +24,69 @@ DATABASES_FOLDER_RELPATH = os.path.join(
 DB_PATH = os.path.join(
     DATABASES_FOLDER_RELPATH,
     configurations["database"]["name"])
+# files of the database including the ones created by the WAL journal mode
+DB_FPATHS = (DB_PATH, DB_PATH + "-wal", DB_PATH + "-shm")
 FAISS_INDEX_FPATH = os.path.join(
     DATABASES_FOLDER_RELPATH,
     configurations["database"]["faiss_index_fname"])
+EMBEDDINGS_FPATH = os.path.join(
+    DATABASES_FOLDER_RELPATH,
+    configurations["database"]["embeddings_fname"])
+# the compacted embeddings file is written here before it replaces the
+# embeddings file
+COMPACTED_EMBEDDINGS_FPATH = EMBEDDINGS_FPATH + ".tmp"
+
+# data type of the embeddings stored in the embeddings file, only floating
+# point types keep the normalized embeddings whose values are in [-1, 1]
+EMBEDDING_DTYPES = ("float16", "float32")
+EMBEDDING_DTYPE = configurations["embedding_model"]["embedding_dtype"]
+if EMBEDDING_DTYPE not in EMBEDDING_DTYPES:
+    raise ValueError(f"Unsupported embedding dtype: '{EMBEDDING_DTYPE}'. "
+                     f"Supported values are: {', '.join(EMBEDDING_DTYPES)}. "
+                     "To quantize the embeddings to 8 bits, use an 'SQ8' "
+                     "faiss index factory string instead.")
+EMBEDDING_DTYPE = np.dtype(EMBEDDING_DTYPE)
+
+# format of the timestamps stored in the database
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# names of the tables in the database
+TABLE_NAME_DOCUMENTS = configurations["database"]["table_name_documents"]
+TABLE_NAME_EMBEDDINGS = configurations["database"]["table_name_embeddings"]
+
+# sql statements that are executed repeatedly are built only once
+SELECT_DOC_ID_SQL = f"""SELECT id FROM {TABLE_NAME_DOCUMENTS}
+                        WHERE filepath = ?;"""
+INSERT_DOCUMENTS_SQL = f"""INSERT INTO {TABLE_NAME_DOCUMENTS} (filename,
+                           filepath, last_modified, inserted_at)
+                           VALUES (?, ?, ?, ?);"""
+INSERT_EMBEDDINGS_SQL = f"""INSERT INTO {TABLE_NAME_EMBEDDINGS} (doc_id,
+                            page_number, chunk, embedding_offset)
+                            VALUES (?, ?, ?, ?);"""
+DELETE_DOC_EMBEDDINGS_SQL = f"""DELETE FROM {TABLE_NAME_EMBEDDINGS}
+                                WHERE doc_id = ?;"""
+UPDATE_LAST_MODIFIED_SQL = f"""UPDATE {TABLE_NAME_DOCUMENTS} SET
+                               last_modified = ?, inserted_at = ?
+                               WHERE id = ?;"""
+
+# last modified time of documents that are not embedded yet, so that they
+# are embedded by the next update if embedding them fails
+NOT_EMBEDDED = ""
+
+# number of rows fetched at once when reading large tables
+FETCH_BATCH_SIZE = 10000
 
 # set up logging
 setup_logging()
 logger = logging.getLogger("rag_data_management_logger")
 
+# use all the cpu cores for faiss
+faiss.omp_set_num_threads(os.cpu_count())
+
 
 def create_database() -> sqlite3.Connection:
     """Method to create a fresh database by deleting the old
-    database if it exists.
+    database and embeddings file if they exist.
 
     Args:
         None
@@ -46,10 +94,14 @@ def create_database() -> sqlite3.Connection:
     Returns:
         sqlite3.Connection: connection object.
     """
-    if os.path.exists(DB_PATH):
-        os.remove(DB_PATH)
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    # a stale WAL file would otherwise be replayed into the new database
+    for fpath in DB_FPATHS:
+        if os.path.exists(fpath):
+            os.remove(fpath)
+    for fpath in (EMBEDDINGS_FPATH, COMPACTED_EMBEDDINGS_FPATH):
+        if os.path.exists(fpath):
+            os.remove(fpath)
+    conn, cursor = connect_to_db()
     logger.info(f"Database created successfully: {DB_PATH}")
     create_tables(conn, cursor)
     return conn, cursor
@@ -67,11 +119,8 @@ def create_tables(conn: sqlite3.Connection, cursor: sqlite3.Cursor) -> None:
     Returns:
         None
     """
-    table_name_docs = configurations["database"]["table_name_documents"]
-    table_name_embds = configurations["database"]["table_name_embeddings"]
-    table_name_mapping = configurations["database"]["table_name_faiss_map"]
     cursor.execute(f"""
-                    CREATE TABLE IF NOT EXISTS {table_name_docs}(
+                    CREATE TABLE IF NOT EXISTS {TABLE_NAME_DOCUMENTS}(
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     filename TEXT UNIQUE NOT NULL,
                     filepath TEXT UNIQUE NOT NULL,
@@ -79,22 +128,38 @@ def create_tables(conn: sqlite3.Connection, cursor: sqlite3.Cursor) -> None:
                     inserted_at TEXT NOT NULL);
                 """)
     cursor.execute(f"""
-                    CREATE TABLE IF NOT EXISTS {table_name_embds}(
+                    CREATE TABLE IF NOT EXISTS {TABLE_NAME_EMBEDDINGS}(
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     doc_id INTEGER NOT NULL,
                     page_number INTEGER NOT NULL,
                     chunk TEXT NOT NULL,
-                    embedding BLOB NOT NULL,
-                    FOREIGN KEY(doc_id) REFERENCES {table_name_docs}(id));
+                    embedding_offset INTEGER NOT NULL,
+                    FOREIGN KEY(doc_id) REFERENCES {TABLE_NAME_DOCUMENTS}(id));
                 """)
+    conn.commit()
+    logger.info("Tables created successfully.")
+    create_indexes(conn, cursor)
+
+
+def create_indexes(conn: sqlite3.Connection, cursor: sqlite3.Cursor) -> None:
+    """Method to create the indexes on the columns used for lookups and
+    deletes. The filepath column of the documents table is already indexed
+    through its unique constraint, but sqlite does not index foreign keys.
+
+    Args:
+        conn (sqlite3.Connection): connection object.
+        cursor (sqlite3.Cursor): cursor object.
+
+    Returns:
+        None
+    """
     cursor.execute(f"""
-                    CREATE TABLE IF NOT EXISTS {table_name_mapping}(
-                    faiss_id INTEGER PRIMARY KEY,
-                    embd_id INTEGER NOT NULL,
-                    FOREIGN KEY(embd_id) REFERENCES {table_name_embds}(id));
+                    CREATE INDEX IF NOT EXISTS
+                    ix_{TABLE_NAME_EMBEDDINGS}_doc_id
+                    ON {TABLE_NAME_EMBEDDINGS}(doc_id);
                 """)
     conn.commit()
-    logger.info("Tables created successfully.")
+    logger.info("Indexes created successfully.")
 
 
 def get_filepaths(root_folder: str, file_type: tuple = (".pdf",))\
@@ -110,10 +175,16 @@ def get_filepaths(root_folder: str, file_type: tuple = (".pdf",))\
         list(str): list of file paths.
     """
     file_paths = []
-    for root, _, files in os.walk(root_folder):
-        for file in files:
-            if file.endswith(file_type):
-                file_paths.append(os.path.join(root, file))
+    # scandir caches the file type of the entries, so unlike os.walk no
+    # extra stat call is needed per entry
+    folders = [root_folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.endswith(file_type):
+                    file_paths.append(entry.path)
     return file_paths
 
 
@@ -129,91 +200,99 @@ def get_doc_id(doc_path: str, conn: sqlite3.Connection,
     Returns:
         int: the document id.
     """
-    table_name_docs = configurations["database"]["table_name_documents"]
-    cursor.execute(f"""SELECT id FROM {table_name_docs} WHERE filepath = ?;""",
-                   (doc_path,))
+    cursor.execute(SELECT_DOC_ID_SQL, (doc_path,))
     return cursor.fetchone()[0]
 
 
-def insert_files_metainfo_into_database(conn: sqlite3.Connection,
-                                        cursor: sqlite3.Cursor,
-                                        file_paths: list[str]) -> None:
-    """Method to insert the filenames into the database of any new/modified
-    doc or book in the private library.
+def get_last_modified(file_path: str) -> str:
+    """Method to get the last modified time of a file in the format it is
+    stored in the database.
 
     Args:
-        conn (sqlite3.Connection): connection object.
-        cursor (sqlite3.Cursor): cursor object.
-        file_paths (list(str)): list of file-paths to add the file names in the
-        database.
+        file_path (str): the path of the file.
 
     Returns:
-        None
+        str: the last modified time.
     """
-    table_name_docs = configurations["database"]["table_name_documents"]
-    for path in file_paths:
-        filename = os.path.basename(path)
-        last_modified = datetime.fromtimestamp(
-            os.path.getmtime(path)).strftime("%Y-%m-%d %H:%M:%S")
-        inserted_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute(f"""INSERT INTO {table_name_docs} (filename, filepath,
-                       last_modified, inserted_at) VALUES (?, ?, ?, ?);""",
-                       (filename, path, last_modified, inserted_at))
-        conn.commit()
-        logger.info(f"Inserted file-metadata in database for: {filename}")
+    return time.strftime(TIME_FORMAT,
+                         time.localtime(os.path.getmtime(file_path)))
 
 
-def extract_text_from_pdf(pdf_path: str) -> list[tuple[int, str]]:
-    """Method to extract the text from the documents/books.
+def insert_files_metainfo_into_database(conn: sqlite3.Connection,
+                                        cursor: sqlite3.Cursor,
+                                        file_paths: list[str]) -> list[str]:
+    """Method to insert the filenames into the database of any new/modified
+    doc or book in the private library. Files whose name or path already
+    exists in the database are skipped, since both have to be unique. The
+    last modified time is only set once the document is embedded.
 
     Args:
         conn (sqlite3.Connection): connection object.
         cursor (sqlite3.Cursor): cursor object.
+        file_paths (list(str)): list of file-paths to add the file names in the
+        database.
 
     Returns:
-        list[tuple[int, str]]: a list of tuples representing the page number
-        and the corresponding text for all pages in the document specified by
-        the path.
+        list(str): list of file-paths that were inserted in the database.
     """
-    doc = pymupdf.open(pdf_path)
-    extracted_text = []
-    for page_num, content in enumerate(doc, start=1):
-        extracted_text.append((page_num, content.get_text("text")))
-    return extracted_text
-
-
-def chunk_text(doc: list[tuple[int, str]], window_size: int = 3,
-               stride: int = 2)\
-               -> list[tuple[int, str]]:
-    """Method to split the text into chunks of a sentences of specified
-    size and stride.
+    cursor.execute(f"""SELECT filename, filepath FROM
+                   {TABLE_NAME_DOCUMENTS};""")
+    rows = cursor.fetchall()
+    filenames_in_db = set([row[0] for row in rows])
+    file_paths_in_db = set([row[1] for row in rows])
+    inserted_at = time.strftime(TIME_FORMAT)
+    data = []
+    for path in file_paths:
+        filename = os.path.basename(path)
+        if filename in filenames_in_db or path in file_paths_in_db:
+            logger.warning(f"Skipped the file as a file with the same name "
+                           f"already exists in the database: {path}")
+            continue
+        filenames_in_db.add(filename)
+        file_paths_in_db.add(path)
+        data.append((filename, path, NOT_EMBEDDED, inserted_at))
+    # single transaction for all the rows instead of a commit per file
+    with conn:
+        cursor.executemany(INSERT_DOCUMENTS_SQL, data)
+    logger.info(f"Inserted file-metadata in database for {len(data)} files.")
+    return [row[1] for row in data]
+
+
+def load_embedding_model() -> SentenceTransformer:
+    """Method to load the sentence transformer model used to embed the
+    chunks. It should be loaded once and reused for all the documents. A
+    cuda device is used if available, otherwise the configured device.
 
     Args:
-        doc (list[int, str]): a list of tuples representing the page number
-        and the corresponding text representing the whole document.
-        window_size (int): the number of sentences to combine to make
-        a chunk.
-        stride (int): the number of sentences to skip when combining
-        sentences to make a chunk.
+        None
 
     Returns:
-        list[int, str]: a list of tuples representing the page number
-        and the corresponding text chunk.
+        SentenceTransformer: the embedding model.
     """
-    chunked_text = []
-    for page_num, content in doc:
-        sentences = sent_tokenize(content)
-        for i in range(0, len(sentences) + 1 - window_size, stride):
-            chunk = " ".join(sentences[i: i + window_size])
-            chunked_text.append((page_num, chunk))
-    return chunked_text
+    if torch.cuda.is_available():
+        device = "cuda"
+    else:
+        device = configurations["embedding_model"]["model_device"]
+    model = SentenceTransformer(
+        model_name_or_path=configurations["embedding_model"]["model_name"],
+        device=device)
+    logger.info("Loaded the embedding model: "
+                f"{configurations['embedding_model']['model_name']} on "
+                f"device: {device}")
+    return model
 
 
 def embed_and_store_chunks(doc_id: int, chunked_list: list[tuple[int, str]],
                            conn: sqlite3.Connection,
-                           cursor: sqlite3.Cursor) -> None:
+                           cursor: sqlite3.Cursor,
+                           model: SentenceTransformer,
+                           last_modified: str) -> None:
     """Method to embed the chunks and store them along with the page number,
-    document id and the chink in the database.
+    document id and the chink in the database. The embeddings are appended
+    to the embeddings file and only their row offset in the file is stored
+    in the database. Any previous embeddings of the document are replaced
+    and its last modified time is updated in the same transaction, so that
+    a document is only marked as up to date once it is embedded.
 
     Args:
         doc_id (int): the id of the document whose data is in the chunked list
@@ -221,104 +300,238 @@ def embed_and_store_chunks(doc_id: int, chunked_list: list[tuple[int, str]],
         page number and the corresponding text.
         conn (sqlite3.Connection): connection object.
         cursor (sqlite3.Cursor): cursor object.
+        model (SentenceTransformer): the embedding model.
+        last_modified (str): the last modified time of the document when its
+        text was extracted.
 
     Returns:
         None
     """
-    model = SentenceTransformer(
-        model_name_or_path=configurations["embedding_model"]["model_name"],
-        device=configurations["embedding_model"]["model_device"])
-    batch_size = configurations["embedding_model"]["batch_size"]
-    table_name_embs = configurations["database"]["table_name_embeddings"]
-    for i in range(0, len(chunked_list), batch_size):
-        batch = chunked_list[i: i + batch_size]
-        batch_page_nums, batch_chunks = zip(*batch)
-        batch_embeddings = model.encode(batch_chunks,
-                                        normalize_embeddings=True)
-        batch_doc_id = [doc_id] * len(batch_embeddings)
-        batch_page_nums = list(batch_page_nums)
-        batch_chunks = list(batch_chunks)
-        batch_embeddings = [pickle.dumps(emb) for
-                            emb in list(batch_embeddings)]
-        data = tuple(zip(batch_doc_id, batch_page_nums, batch_chunks,
-                         batch_embeddings))
-        cursor.executemany(f"""INSERT INTO {table_name_embs} (doc_id,
-                           page_number, chunk, embedding)
-                           VALUES (?, ?, ?, ?);""", data)
-        conn.commit()
+    data = []
+    if chunked_list:
+        batch_size = configurations["embedding_model"]["batch_size"]
+        page_nums, chunks = zip(*chunked_list)
+        # the model batches internally, so encode the whole document in one
+        # call
+        embeddings = model.encode(list(chunks), batch_size=batch_size,
+                                  normalize_embeddings=True,
+                                  convert_to_numpy=True,
+                                  show_progress_bar=False)
+        embeddings = np.ascontiguousarray(embeddings, dtype=EMBEDDING_DTYPE)
+        with open(EMBEDDINGS_FPATH, "ab") as f:
+            start_offset = f.tell() // embeddings[0].nbytes
+            f.write(embeddings.tobytes())
+        offsets = range(start_offset, start_offset + len(embeddings))
+        data = zip([doc_id] * len(embeddings), page_nums, chunks, offsets)
+    else:
+        logger.info(f"No chunks to embed for document id: {doc_id}")
+    # commit once per document instead of once per batch
+    with conn:
+        cursor.execute(DELETE_DOC_EMBEDDINGS_SQL, (doc_id,))
+        cursor.executemany(INSERT_EMBEDDINGS_SQL, data)
+        cursor.execute(UPDATE_LAST_MODIFIED_SQL,
+                       (last_modified, time.strftime(TIME_FORMAT), doc_id))
     logger.info(f"Inserted embeddings for document id: {doc_id}")
 
 
-def build_faiss_index(cursor: sqlite3.Cursor) -> tuple[faiss.IndexFlatL2,
-                                                       list[tuple[int, int]]]:
-    """Method to build a faiss index from the embeddings stored in the
-     database.
+def train_faiss_index(faiss_index: faiss.Index,
+                      train_data: np.ndarray) -> faiss.Index:
+    """Method to train a faiss index. The training is done on a gpu if
+    faiss is built with gpu support and one is available, otherwise on the
+    cpu.
 
     Args:
-        cursor (sqlite3.Cursor): cursor object.
+        faiss_index (faiss.Index): untrained faiss index.
+        train_data (np.ndarray): the embeddings to train the index on.
 
     Returns:
-        tuple[faiss.IndexFlatL2, list[tuple[int, int]]]: faiss index and the
-        mapping from faiss index to embedding index in the embedding table.
+        faiss.Index: trained faiss index on the cpu.
     """
-    table_name_embds = configurations["database"]["table_name_embeddings"]
-    cursor.execute(f"""SELECT id, embedding FROM {table_name_embds};""")
-    rows = cursor.fetchall()
-    id, embedding = zip(*rows)
-    id, embedding = list(id), [pickle.loads(e) for e in embedding]
-    embedding = np.array(embedding)
-
-    # build faiss index
-    embedding_dim = embedding.shape[1]
-    faiss_index = faiss.IndexFlatL2(embedding_dim)
-    faiss_index.add(embedding)
-
-    # build a new mapping table of faiss index to embeddings
-    faiss_id = [i for i in range(embedding.shape[0])]
-    mapping_data = list(zip(faiss_id, id))
-    return faiss_index, mapping_data
-
-
-def save_faiss_index(faiss_index: faiss.IndexFlatL2) -> None:
-    """Method to save the faiss index to a file.
+    if hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0:
+        try:
+            gpu_resources = faiss.StandardGpuResources()
+            gpu_index = faiss.index_cpu_to_gpu(gpu_resources, 0, faiss_index)
+            gpu_index.train(train_data)
+            return faiss.index_gpu_to_cpu(gpu_index)
+        except RuntimeError as e:
+            logger.warning(f"Could not train the faiss index on the gpu, "
+                           f"training on the cpu instead: {e}")
+    faiss_index.train(train_data)
+    return faiss_index
+
+
+def compact_embeddings_file(conn: sqlite3.Connection, cursor: sqlite3.Cursor,
+                            id: np.ndarray, embedding: np.ndarray) -> None:
+    """Method to rewrite the embeddings file with only the embeddings that
+    are still in the embedding table, so that the embeddings of deleted or
+    modified documents do not accumulate in the file. The compacted file
+    only replaces the embeddings file once the new offsets are committed, so
+    that an interrupted compaction can be completed or discarded by
+    recover_embeddings_file.
 
     Args:
-        faiss_index (faiss.IndexFlatL2): faiss index.
+        conn (sqlite3.Connection): connection object.
+        cursor (sqlite3.Cursor): cursor object.
+        id (np.ndarray): the ids of the embeddings in the embedding table.
+        embedding (np.ndarray): the corresponding embeddings.
 
     Returns:
         None
     """
-    faiss.write_index(faiss_index, FAISS_INDEX_FPATH)
-    logger.info(f"Saved faiss index to file: {FAISS_INDEX_FPATH}")
+    with open(COMPACTED_EMBEDDINGS_FPATH, "wb") as f:
+        embedding.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    with conn:
+        cursor.executemany(f"""UPDATE {TABLE_NAME_EMBEDDINGS} SET
+                           embedding_offset = ? WHERE id = ?;""",
+                           zip(range(len(id)), id.tolist()))
+    os.replace(COMPACTED_EMBEDDINGS_FPATH, EMBEDDINGS_FPATH)
+    logger.info(f"Compacted the embeddings file: {EMBEDDINGS_FPATH}")
+
+
+def recover_embeddings_file(cursor: sqlite3.Cursor) -> None:
+    """Method to finish or discard a compaction of the embeddings file that
+    was interrupted. If the offsets of the compacted file were committed,
+    the compacted file replaces the embeddings file, otherwise it is
+    deleted and the embeddings file is still the one the offsets refer to.
 
+    Args:
+        cursor (sqlite3.Cursor): cursor object.
 
-def save_faiss_mapping(mapping_data: list[tuple[int, int]],
-                       conn: sqlite3.Connection,
-                       cursor: sqlite3.Cursor) -> None:
-    """Method to save the mapping of faiss index to embedding index
-    in the database.
+    Returns:
+        None
+    """
+    if not os.path.exists(COMPACTED_EMBEDDINGS_FPATH):
+        return
+    embedding_dim = configurations["embedding_model"]["embedding_dimension"]
+    cursor.execute(f"""SELECT COUNT(*), COUNT(DISTINCT embedding_offset),
+                   MIN(embedding_offset), MAX(embedding_offset)
+                   FROM {TABLE_NAME_EMBEDDINGS};""")
+    num_rows, num_offsets, min_offset, max_offset = cursor.fetchone()
+    # the offsets of a compacted file are exactly 0 to the number of rows
+    is_committed = (
+        num_rows > 0 and num_offsets == num_rows and min_offset == 0
+        and max_offset == num_rows - 1
+        and os.path.getsize(COMPACTED_EMBEDDINGS_FPATH)
+        == num_rows * embedding_dim * EMBEDDING_DTYPE.itemsize)
+    if is_committed:
+        os.replace(COMPACTED_EMBEDDINGS_FPATH, EMBEDDINGS_FPATH)
+        logger.info(f"Completed the interrupted compaction of the "
+                    f"embeddings file: {EMBEDDINGS_FPATH}")
+    else:
+        os.remove(COMPACTED_EMBEDDINGS_FPATH)
+        logger.info(f"Discarded the interrupted compaction of the "
+                    f"embeddings file: {EMBEDDINGS_FPATH}")
+
+
+def build_faiss_index(conn: sqlite3.Connection,
+                      cursor: sqlite3.Cursor) -> faiss.IndexIDMap2:
+    """Method to build a faiss index from the embeddings stored in the
+     database. The index type is specified by the faiss index factory string
+     in the configurations, where "{nlist}" is replaced by a number of
+     inverted lists suited to the number of embeddings. If there are too few
+     embeddings to train it, a flat index is built instead. The ids of the
+     faiss index are the ids of the embeddings in the embedding table. The
+     embeddings are read from the memory-mapped embeddings file, which is
+     compacted if it contains embeddings no longer in the database.
 
     Args:
-        mapping_data (list[tuple[int, int]]): faiss index.
         conn (sqlite3.Connection): connection object.
         cursor (sqlite3.Cursor): cursor object.
 
+    Returns:
+        faiss.IndexIDMap2: faiss index.
+    """
+    embedding_dim = configurations["embedding_model"]["embedding_dimension"]
+    cursor.execute(f"""SELECT COUNT(*) FROM {TABLE_NAME_EMBEDDINGS};""")
+    num_rows = cursor.fetchone()[0]
+    if num_rows == 0:
+        logger.warning("No embeddings in the database, the faiss index is "
+                       "empty.")
+        if os.path.exists(EMBEDDINGS_FPATH):
+            os.remove(EMBEDDINGS_FPATH)
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(embedding_dim))
+
+    # fill pre-allocated arrays in batches of rows streamed from the cursor
+    # to avoid materializing all the rows at once
+    id = np.empty(num_rows, dtype=np.int64)
+    offset = np.empty(num_rows, dtype=np.int64)
+    cursor.arraysize = FETCH_BATCH_SIZE
+    # the offsets increase with the ids as the embeddings are appended
+    cursor.execute(f"""SELECT id, embedding_offset FROM
+                   {TABLE_NAME_EMBEDDINGS} ORDER BY id;""")
+    i = 0
+    while rows := cursor.fetchmany():
+        rows = np.array(rows, dtype=np.int64)
+        id[i: i + len(rows)] = rows[:, 0]
+        offset[i: i + len(rows)] = rows[:, 1]
+        i += len(rows)
+    stored_embedding = np.memmap(EMBEDDINGS_FPATH, dtype=EMBEDDING_DTYPE,
+                                 mode="r").reshape(-1, embedding_dim)
+    if offset.max() >= stored_embedding.shape[0]:
+        raise RuntimeError(f"The embeddings file {EMBEDDINGS_FPATH} does not "
+                           f"match the database {DB_PATH}. Run "
+                           "'rebuild_all' to build them again.")
+    if not np.array_equal(offset, np.arange(stored_embedding.shape[0])):
+        # the file still has embeddings of deleted or modified files
+        used_embedding = stored_embedding[offset]
+        del stored_embedding
+        compact_embeddings_file(conn, cursor, id, used_embedding)
+        stored_embedding = used_embedding
+    # faiss expects float32, this does not copy if they are stored as float32
+    embedding = np.ascontiguousarray(stored_embedding, dtype=np.float32)
+
+    # build faiss index, embeddings are normalized so inner product is the
+    # cosine similarity
+    faiss_config = configurations["faiss_index"]
+    index_factory = faiss_config["index_factory"].format(
+        nlist=max(1, int(4 * np.sqrt(num_rows))))
+    faiss_index = faiss.index_factory(embedding_dim, index_factory,
+                                      faiss.METRIC_INNER_PRODUCT)
+    if not faiss_index.is_trained:
+        train_sample_size = faiss_config["train_sample_size"]
+        if num_rows > train_sample_size:
+            sample_ids = np.random.default_rng(seed=0).choice(
+                num_rows, size=train_sample_size, replace=False)
+            train_data = embedding[np.sort(sample_ids)]
+        else:
+            train_data = embedding
+        try:
+            faiss_index = train_faiss_index(faiss_index, train_data)
+        except RuntimeError as e:
+            logger.warning(f"Could not train the faiss index "
+                           f"'{index_factory}' on {num_rows} "
+                           f"embeddings, using a flat index instead: {e}")
+            faiss_index = faiss.IndexFlatIP(embedding_dim)
+    # only inverted file indexes have lists to probe
+    ivf_index = faiss.try_extract_index_ivf(faiss_index)
+    if ivf_index is not None:
+        ivf_index.nprobe = faiss_config["nprobe"]
+    faiss_index = faiss.IndexIDMap2(faiss_index)
+    faiss_index.add_with_ids(embedding, id)
+    return faiss_index
+
+
+def save_faiss_index(faiss_index: faiss.Index) -> None:
+    """Method to save the faiss index to a file.
+
+    Args:
+        faiss_index (faiss.Index): faiss index.
+
     Returns:
         None
     """
-    table_name_mapping = configurations["database"]["table_name_faiss_map"]
-    cursor.executemany(f"""INSERT INTO {table_name_mapping} (faiss_id, embd_id)
-                       VALUES (?, ?);""", mapping_data)
-    conn.commit()
-    logger.info("Inserted faiss mapping into the database.")
+    faiss.write_index(faiss_index, FAISS_INDEX_FPATH)
+    logger.info(f"Saved faiss index to file: {FAISS_INDEX_FPATH}")
 
 
 def cleanup(conn: sqlite3.Connection) -> None:
-    """Method to save the mapping of faiss index to embedding index
-        in the database.
+    """Method to close the database connection and delete the database
+    files, including the WAL files, the faiss index file and the embeddings
+    files, e.g. when building the databases fails.
 
     Args:
-        mapping_data (list[tuple[int, int]]): faiss index.
         conn (sqlite3.Connection): connection object.
 
     Returns:
@@ -327,12 +540,38 @@ def cleanup(conn: sqlite3.Connection) -> None:
     if conn:
         conn.close()
         logger.info("Closed the database connection.")
-    if os.path.exists(DB_PATH):
-        os.remove(DB_PATH)
-        logger.info(f"Deleted the database file: {DB_PATH}")
+    for fpath in DB_FPATHS:
+        if os.path.exists(fpath):
+            os.remove(fpath)
+            logger.info(f"Deleted the database file: {fpath}")
     if os.path.exists(FAISS_INDEX_FPATH):
         os.remove(FAISS_INDEX_FPATH)
         logger.info(f"Deleted the faiss index file: {FAISS_INDEX_FPATH}")
+    for fpath in (EMBEDDINGS_FPATH, COMPACTED_EMBEDDINGS_FPATH):
+        if os.path.exists(fpath):
+            os.remove(fpath)
+            logger.info(f"Deleted the embeddings file: {fpath}")
+
+
+def check_database_schema(cursor: sqlite3.Cursor) -> None:
+    """Method to check that the database was built with the current schema,
+    where the embeddings are stored in the embeddings file.
+
+    Args:
+        cursor (sqlite3.Cursor): cursor object.
+
+    Returns:
+        None
+
+    Raises:
+        RuntimeError: if the database is missing or has an older schema.
+    """
+    cursor.execute(f"""PRAGMA table_info({TABLE_NAME_EMBEDDINGS});""")
+    columns = set([row[1] for row in cursor.fetchall()])
+    if "embedding_offset" not in columns:
+        raise RuntimeError(f"The database {DB_PATH} is missing or was built "
+                           "by an older version. Run 'rebuild_all' to build "
+                           "it again.")
 
 
 def connect_to_db() -> tuple[sqlite3.Connection, sqlite3.Cursor]:
@@ -346,49 +585,54 @@ def connect_to_db() -> tuple[sqlite3.Connection, sqlite3.Cursor]:
     """
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
+    # WAL with normal sync avoids an fsync on every commit
+    cursor.execute("PRAGMA journal_mode=WAL;")
+    cursor.execute("PRAGMA synchronous=NORMAL;")
     return conn, cursor
 
 
-def get_list_of_deleted_files(root_folder: str, conn: sqlite3.Connection,
+def get_list_of_changed_files(root_folder: str, conn: sqlite3.Connection,
                               cursor: sqlite3.Cursor,
-                              file_type: tuple = (".pdf",)) -> list[str]:
-    """Method to get the file path of any deleted files of specified type
-    from the provided file type by checking the file-meta data in the db.
+                              file_type: tuple = (".pdf",))\
+                              -> tuple[list[str], list[str], list[str]]:
+    """Method to get the file path of any new, modified and deleted files of
+    specified type by comparing the files in the root folder with the
+    file-meta data in the db. A file is modified if its last modified time
+    differs from the one in the db, which includes files whose embedding has
+    not completed. The root folder is scanned only once.
 
     Args:
         root_folder (str): the root folder to search for files.
+        conn (sqlite3.Connection): connection object.
+        cursor (sqlite3.Cursor): cursor object.
         file_types (tuple(str)): tuple of file types to search for.
 
     Returns:
-        list(str): list of file paths.
+        tuple[list(str), list(str), list(str)]: list of file paths of the new
+        files, the modified files and the deleted files.
     """
-    file_paths_in_root = []
-    for root, _, files in os.walk(root_folder):
-        for file in files:
-            if file.endswith(file_type):
-                file_paths_in_root.append(os.path.join(root, file))
-    file_paths_in_root = set(file_paths_in_root)
-    cursor.execute(f"""SELECT filepath FROM {
-                   configurations["database"]["table_name_documents"]};""")
-    rows = cursor.fetchall()
-    file_paths_in_db = set([row[0] for row in rows])
-    return list(file_paths_in_db - file_paths_in_root)
-
-
-def delete_faiss_index(conn: sqlite3.Connection, cursor: sqlite3.Cursor)\
-                       -> None:
-    """Method to delete the faiss index from the db.
+    file_paths_in_root = set(get_filepaths(root_folder, file_type))
+    cursor.execute(f"""SELECT filepath, last_modified FROM
+                   {TABLE_NAME_DOCUMENTS};""")
+    last_modified_in_db = dict(cursor.fetchall())
+    file_paths_in_db = set(last_modified_in_db)
+    modified_file_paths = [
+        path for path in file_paths_in_root & file_paths_in_db
+        if get_last_modified(path) != last_modified_in_db[path]]
+    return (list(file_paths_in_root - file_paths_in_db),
+            modified_file_paths,
+            list(file_paths_in_db - file_paths_in_root))
+
+
+def delete_faiss_index() -> None:
+    """Method to delete the faiss index file.
 
     Args:
-        cursor (sqlite3.Cursor): cursor object.
+        None
 
     Returns:
         None
     """
-    table_name_mapping = configurations["database"]["table_name_faiss_map"]
-    cursor.execute(f"""DELETE FROM {table_name_mapping};""")
-    conn.commit()
-    logger.info("Emptied the faiss index mapping table.")
     if os.path.exists(FAISS_INDEX_FPATH):
         os.remove(FAISS_INDEX_FPATH)
         logger.info(f"Deleted the faiss index file: {FAISS_INDEX_FPATH}")
@@ -406,47 +650,15 @@ def delete_file_metadata_in_db(paths: list[str], conn: sqlite3.Connection,
     Returns:
         None
     """
-    table_name_docs = configurations["database"]["table_name_documents"]
-    table_name_embds = configurations["database"]["table_name_embeddings"]
     placeholder_paths = ",".join("?" * len(paths))
     paths = tuple(paths)
-    cursor.execute(f"""SELECT id FROM {table_name_docs} WHERE
-                    filepath IN ({placeholder_paths});""", paths)
-    doc_ids = cursor.fetchall()
-    doc_ids = tuple([doc_id[0] for doc_id in doc_ids])
-    placeholder_dos_ids = ",".join("?" * len(doc_ids))
-    cursor.execute(f"""DELETE FROM {table_name_embds} WHERE
-                    doc_id IN ({placeholder_dos_ids});""", doc_ids)
-    conn.commit()
-    cursor.execute(f"""DELETE FROM {table_name_docs} WHERE
-                    filepath IN ({placeholder_paths});""", paths)
-    conn.commit()
+    # delete the embeddings and the documents in a single transaction
+    with conn:
+        cursor.execute(f"""DELETE FROM {TABLE_NAME_EMBEDDINGS} WHERE
+                        doc_id IN (SELECT id FROM {TABLE_NAME_DOCUMENTS} WHERE
+                        filepath IN ({placeholder_paths}));""", paths)
+        cursor.execute(f"""DELETE FROM {TABLE_NAME_DOCUMENTS} WHERE
+                        filepath IN ({placeholder_paths});""", paths)
     for path in paths:
         logger.info(f"Deleted the file meta-data for: {path}")
-    delete_faiss_index(conn, cursor)
-
-
-def get_list_of_new_files(root_folder: str, conn: sqlite3.Connection,
-                          cursor: sqlite3.Cursor,
-                          file_type: tuple = (".pdf",)) -> list[str]:
-    """Method to get the file path of any new files of specified type
-    from the provided file type by checking the file-meta data in the db.
-
-    Args:
-        root_folder (str): the root folder to search for files.
-        file_types (tuple(str)): tuple of file types to search for.
-
-    Returns:
-        list(str): list of file paths.
-    """
-    file_paths_in_root = []
-    for root, _, files in os.walk(root_folder):
-        for file in files:
-            if file.endswith(file_type):
-                file_paths_in_root.append(os.path.join(root, file))
-    file_paths_in_root = set(file_paths_in_root)
-    cursor.execute(f"""SELECT filepath FROM {
-                   configurations["database"]["table_name_documents"]};""")
-    rows = cursor.fetchall()
-    file_paths_in_db = set([row[0] for row in rows])
-    return list(file_paths_in_root - file_paths_in_db)
+    delete_faiss_index()